@@ -1,11 +1,14 @@
+import argparse
+import collections
 import contextlib
+import copy
 import enum
-import io
+import functools
+import json
 import logging
 import os
 import re
 import sys
-import yaml
 
 
 class _FormatEnum(enum.Enum):
@@ -30,6 +33,7 @@ def _Z8_of(input_ZID, output_ZID):
     }
 
 
+@functools.lru_cache(maxsize=None)
 def _Z9_of(ZID):
     """Convenience function for creating specialized Z9 types."""
     return {
@@ -50,6 +54,7 @@ def _Z9_of(ZID):
     }
 
 
+@functools.lru_cache(maxsize=None)
 def _Z10_of(ZID):
     """Convenience function for creating specialized Z10 types."""
     return {
@@ -373,17 +378,289 @@ _BUILTIN_TYPES = {
 }
 
 
-_RECORD_PATTERN = re.compile(r"^Z[1-9]\d*(K[1-9]\d*)?$")
+_RECORD_PATTERN = re.compile(r"^Z[1-9]\d*(?:K[1-9]\d*)?$")
+
+
+# A builtin spec split into its meta fields and its record properties, so that
+# spec processing never has to tell the two apart again.
+_CompiledSpec = collections.namedtuple(
+    "_CompiledSpec",
+    [
+        "comment",
+        "references",
+        "literally",
+        "properties",
+        "not_required",
+        "pattern_properties",
+        "additional_properties",
+        "cant_be",
+    ],
+)
+
+
+def _reference_kind(value):
+    """Returns "internal" or "external" for a reference leaf dict, else None.
+
+    Reference leaves are {"internal": ZID} or {"external": ZID[, "id": ID]},
+    with keys in any order.
+    """
+    if len(value) <= 2:
+        if "internal" in value:
+            return "internal"
+        if "external" in value:
+            return "external"
+    return None
+
+
+def _is_valid_property(key, value):
+    if key == "Z1K1" and value == "special":
+        return True
+    # Otherwise the property must be a reference leaf; _reference_kind is the
+    # same test _replace_leaves uses to find the leaves it resolves.
+    return isinstance(value, dict) and _reference_kind(value) is not None
+
+
+def _compile_spec(spec):
+    match = _RECORD_PATTERN.match
+    properties = {key: value for key, value in spec.items() if match(key)}
+    for key, value in properties.items():
+        if not _is_valid_property(key, value):
+            raise ValueError(f"Unrecognized property spec: {key}={value!r}")
+    references = spec.get("references", {})
+    return _CompiledSpec(
+        comment=spec.get("comment"),
+        references={
+            sys.intern(key): _compile_spec(value) for key, value in references.items()
+        },
+        literally=spec.get("literally"),
+        properties=properties,
+        not_required=frozenset(spec.get("notRequired", ())),
+        pattern_properties=spec.get("patternProperties"),
+        # TODO: This can be a reference, too.
+        additional_properties=bool(spec.get("additionalProperties")),
+        cant_be=frozenset(spec.get("cant_be", ())),
+    )
+
+
+def _compile_builtins(builtin_types):
+    return {
+        form: {sys.intern(ZID): _compile_spec(spec) for ZID, spec in specs.items()}
+        for form, specs in builtin_types.items()
+    }
+
+
+_COMPILED_TYPES = _compile_builtins(_BUILTIN_TYPES)
+
+
+def _replace_leaves(spec, resolve_leaf):
+    """Returns spec with its reference leaves replaced by resolve_leaf.
+
+    resolve_leaf maps the kind of a leaf (see _reference_kind) and the leaf
+    itself to its $ref dict.
+    """
+    # First find the path to every reference leaf, then copy only the
+    # containers along those paths and assign the $ref dicts in place.
+    # Subtrees without references are shared with the (read-only) spec.
+    leaves = []
+    stack = [((), spec)]
+    while stack:
+        path, node = stack.pop()
+        items = node.items() if isinstance(node, dict) else enumerate(node)
+        for key, value in items:
+            if isinstance(value, dict):
+                kind = _reference_kind(value)
+                if kind is not None:
+                    leaves.append((path + (key,), resolve_leaf(kind, value)))
+                    continue
+                stack.append((path + (key,), value))
+            elif isinstance(value, list):
+                stack.append((path + (key,), value))
+
+    result = dict(spec)
+    copied = {id(result)}
+    for path, reference in leaves:
+        node = result
+        for key in path[:-1]:
+            child = node[key]
+            if id(child) not in copied:
+                child = node[key] = copy.copy(child)
+                copied.add(id(child))
+            node = child
+        node[path[-1]] = reference
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def _special_z1k1(zid):
+    """Schema for a Z1K1 that must be a Z9/Reference to zid."""
+    return {
+        "type": "object",
+        "required": ["Z1K1", "Z9K1"],
+        "properties": {
+            "Z1K1": {
+                "type": "string",
+                "enum": ["Z9"],
+            },
+            "Z9K1": {
+                "type": "string",
+                "enum": [zid],
+            },
+        },
+        "additionalProperties": False,
+    }
+
+
+# Strings that can be emitted as plain YAML scalars: anything else (including
+# words YAML 1.1 would read as booleans or null) is emitted double-quoted.
+_PLAIN_SCALAR_PATTERN = re.compile(r"[A-Za-z_$][A-Za-z0-9_$]*")
+_RESERVED_SCALARS = frozenset(["true", "false", "yes", "no", "on", "off", "null"])
+
+
+# Characters json.dumps(..., ensure_ascii=False) leaves unescaped but which
+# are not printable ASCII.
+_NON_ASCII_PATTERN = re.compile(r"[^ -~]")
+
+
+def _escape_non_ascii(match):
+    # json.dumps would write code points above U+FFFF as surrogate pairs,
+    # which YAML reads back as two separate characters.
+    code_point = ord(match.group())
+    if code_point > 0xFFFF:
+        return f"\\U{code_point:08x}"
+    return f"\\u{code_point:04x}"
+
+
+# Rendered string scalars; schemata reuse a small set of keys and values.
+_SCALAR_CACHE = {}
+
+
+def _yaml_scalar(value):
+    if isinstance(value, str):
+        scalar = _SCALAR_CACHE.get(value)
+        if scalar is None:
+            if _PLAIN_SCALAR_PATTERN.fullmatch(value) and (
+                value.lower() not in _RESERVED_SCALARS
+            ):
+                scalar = value
+            else:
+                # A JSON string is also a valid double-quoted YAML scalar, as
+                # long as it only contains printable ASCII.
+                scalar = _NON_ASCII_PATTERN.sub(
+                    _escape_non_ascii, json.dumps(value, ensure_ascii=False)
+                )
+            _SCALAR_CACHE[value] = scalar
+        return scalar
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return str(value)
+    if value == {}:
+        return "{}"
+    if value == []:
+        return "[]"
+    raise TypeError(f"Cannot emit {value!r} as YAML")
+
+
+def _emit_mapping(mapping, out, indent, first_indent=None):
+    write = out.write
+    for key, value in mapping.items():
+        prefix = indent if first_indent is None else first_indent
+        first_indent = None
+        if value and isinstance(value, dict):
+            write(f"{prefix}{_yaml_scalar(key)}:\n")
+            _emit_mapping(value, out, indent + "  ")
+        elif value and isinstance(value, list):
+            write(f"{prefix}{_yaml_scalar(key)}:\n")
+            _emit_sequence(value, out, indent)
+        else:
+            write(f"{prefix}{_yaml_scalar(key)}: {_yaml_scalar(value)}\n")
+
+
+def _emit_sequence(sequence, out, indent, first_indent=None):
+    for element in sequence:
+        prefix = (indent if first_indent is None else first_indent) + "- "
+        first_indent = None
+        if element and isinstance(element, dict):
+            _emit_mapping(element, out, indent + "  ", prefix)
+        elif element and isinstance(element, list):
+            _emit_sequence(element, out, indent + "  ", prefix)
+        else:
+            out.write(f"{prefix}{_yaml_scalar(element)}\n")
+
+
+@functools.lru_cache(maxsize=None)
+def _pyyaml_dumper():
+    try:
+        from yaml import CSafeDumper as SafeDumper
+    except ImportError:
+        from yaml import SafeDumper
+
+    class Dumper(SafeDumper):
+        # $ref dicts are shared between nodes; write each occurrence out in
+        # full rather than as YAML anchors and aliases.
+        def ignore_aliases(self, data):
+            return True
+
+    return Dumper
+
+
+def _dump_with_pyyaml(schema, out):
+    # PyYAML is only imported here: it is the slowest import of the script and
+    # only the --safe path needs it.
+    import yaml
+
+    # Keys are written in construction order, as _emit_yaml does, so PyYAML
+    # does not have to sort every mapping.
+    yaml.dump(
+        schema,
+        out,
+        Dumper=_pyyaml_dumper(),
+        default_flow_style=False,
+        sort_keys=False,
+        allow_unicode=True,
+    )
+
+
+def _emit_yaml(schema, out):
+    """Writes schema as block-style YAML.
+
+    This only handles the node types schemata are made of (dicts, lists,
+    strings, booleans, integers and None), which makes it several times faster
+    than yaml.dump, even with LibYAML.
+    """
+    _emit_mapping(schema, out, "")
 
 
 class SchemaComponent:
 
+    __slots__ = (
+        "_form",
+        "_builtin_dict",
+        "_to_update",
+        "_references",
+        "_external_references",
+        "_root",
+        "_tag",
+        "_emitted",
+        "_ref_cache",
+    )
+
     _DEFINITIONS_PATH = ["definitions", "objects"]
+    _REF_PREFIX = "#/" + "/".join(_DEFINITIONS_PATH) + "/"
+
+    # Resolved specs, shared by all components: {(form, ZID, tag): spec}.
+    _RESOLVED_SPECS = {}
 
     def __init__(self, form="NORMAL"):
-        form = getattr(_FormatEnum, form)
-        self._builtin_dict = _BUILTIN_TYPES[form]
-        self._to_update = []
+        self._form = getattr(_FormatEnum, form)
+        self._builtin_dict = _COMPILED_TYPES[self._form]
+        # Specs still to be written out, processed last in, first out.
+        self._to_update = collections.deque()
+        self._references = {}
+        self._external_references = {}
+        self._ref_cache = {}
 
     def _id_for(self, ZID):
         if self._tag is None:
@@ -391,125 +668,139 @@ class SchemaComponent:
         return f"{self._tag}_{ZID}"
 
     def _reference_for(self, ZID):
-        return "/".join(["#"] + self._DEFINITIONS_PATH + [ZID])
+        reference = self._references.get(ZID)
+        if reference is None:
+            reference = self._REF_PREFIX + ZID
+            self._references[ZID] = reference
+        return reference
 
     def _ref_dict(self, value):
-        return {"$ref": value}
+        # $ref dicts are never mutated, so share one per reference string.
+        ref_dict = self._ref_cache.get(value)
+        if ref_dict is None:
+            ref_dict = self._ref_cache[value] = {"$ref": value}
+        return ref_dict
 
     def _external_reference(self, ZID, external_id=None):
         if external_id is None:
             external_id = ZID
-        return f"{self._id_for(external_id)}{self._reference_for(ZID)}"
-
-    def _special_z1k1(self, zid):
-        return {
-            "type": "object",
-            "required": ["Z1K1", "Z9K1"],
-            "properties": {
-                "Z1K1": {
-                    "type": "string",
-                    "enum": ["Z9"],
-                },
-                "Z9K1": {
-                    "type": "string",
-                    "enum": [zid],
-                },
-            },
-            "additionalProperties": False,
-        }
+        # The ID of the external schema depends on the tag.
+        key = (self._tag, ZID, external_id)
+        reference = self._external_references.get(key)
+        if reference is None:
+            reference = f"{self._id_for(external_id)}{self._reference_for(ZID)}"
+            self._external_references[key] = reference
+        return reference
 
-    def _replace_references(self, spec):
-        result = {}
-        for key, value in spec.items():
-            if isinstance(value, dict):
-                internal = value.get("internal")
-                if internal is not None:
-                    result[key] = self._ref_dict(self._reference_for(internal))
-                    continue
+    def _internal_leaf(self, value):
+        return self._ref_dict(self._reference_for(value["internal"]))
 
-                external = value.get("external")
-                if external is not None:
-                    args = [external]
-                    extern_id = value.get("id")
-                    if extern_id is not None:
-                        args.append(extern_id)
-                    result[key] = self._ref_dict(self._external_reference(*args))
-                    continue
+    def _external_leaf(self, value):
+        return self._ref_dict(
+            self._external_reference(value["external"], value.get("id"))
+        )
 
-                result[key] = self._replace_references(value)
-            elif isinstance(value, list):
-                new_list = []
-                for element in value:
-                    # TODO: Fix this kludge.
-                    augmented = {"element": element}
-                    replaced = self._replace_references(augmented)
-                    new_list.append(replaced["element"])
-                result[key] = new_list
-            else:
-                result[key] = value
-        return result
+    # Handlers for each kind returned by _reference_kind.
+    _REF_HANDLERS = {"internal": _internal_leaf, "external": _external_leaf}
+
+    def _resolve_leaf(self, kind, value):
+        return self._REF_HANDLERS[kind](self, value)
+
+    def _replace_references(self, spec):
+        return _replace_leaves(spec, self._resolve_leaf)
+
+    def _resolve_spec(self, spec):
+        literally = spec.literally
+        if literally is not None:
+            literally = self._replace_references(literally)
+        pattern_properties = spec.pattern_properties
+        if pattern_properties is not None:
+            pattern_properties = self._replace_references(pattern_properties)
+        return spec._replace(
+            references={
+                key: self._resolve_spec(value) for key, value in spec.references.items()
+            },
+            literally=literally,
+            properties=self._replace_references(spec.properties),
+            pattern_properties=pattern_properties,
+        )
+
+    def _resolved_spec(self, ZID):
+        # External references depend on the tag, so it is part of the key.
+        key = (self._form, ZID, self._tag)
+        resolved = self._RESOLVED_SPECS.get(key)
+        if resolved is None:
+            resolved = self._resolve_spec(self._builtin_dict[ZID])
+            self._RESOLVED_SPECS[key] = resolved
+        return resolved
 
     def _update_from_spec(self, object_dict, zid, display_zid, spec):
-        # TODO: Exit early if this is already populated.
+        # Exit early if this is already populated.
+        if zid in self._emitted:
+            return
+        self._emitted.add(zid)
         zid_dict = object_dict.setdefault(zid, {})
 
         # Step 1: create internal references.
-        references = spec.get("references")
-        if references is not None:
-            for key, value in references.items():
-                self._to_update.append((key, display_zid, value))
+        for key, value in spec.references.items():
+            self._to_update.append((key, display_zid, value))
 
         # Step 2: if spec has "literally," processing should stop after.
-        literally = spec.get("literally")
-        if literally is not None:
-            zid_dict.update(literally)
+        if spec.literally is not None:
+            zid_dict.update(spec.literally)
             return
 
         # Step 3: populate properties.
         properties_dict = {}
-        required = set()
-        for key, value in spec.items():
-            if not _RECORD_PATTERN.match(key):
-                continue
-            if "$ref" in value:
-                properties_dict[key] = value
-                continue
-            if key == "Z1K1" and value == "special":
+        # Property specs were validated by _compile_spec: each is either a
+        # special Z1K1 or a resolved reference.
+        for key, value in spec.properties.items():
+            if value == "special":
                 allof = properties_dict.setdefault(key, {}).setdefault("allOf", [])
                 allof.append(self._ref_dict(self._external_reference("Z9")))
-                allof.append(self._special_z1k1(display_zid))
-                continue
-            logging.debug(f"Unrecognized property spec: {{{key}: {value}}}")
-            raise Exception
+                allof.append(_special_z1k1(display_zid))
+            else:
+                properties_dict[key] = value
 
         if properties_dict:
             zid_dict["properties"] = properties_dict
 
         # Step 4: non-required properties (we require properties by default).
-        required = set(properties_dict.keys()) - set(spec.get("notRequired", {}))
+        required = [key for key in properties_dict if key not in spec.not_required]
         if required:
-            zid_dict["required"] = sorted(list(required))
+            zid_dict["required"] = required
 
         # Step 5: process pattern properties.
-        pattern_properties = spec.get("patternProperties")
-        if pattern_properties is not None:
-            zid_dict["patternProperties"] = pattern_properties
+        if spec.pattern_properties is not None:
+            zid_dict["patternProperties"] = spec.pattern_properties
 
         # Step 6: process additionalProperties (prohibited by default).
-        allow_additional = False
-        if spec.get("additionalProperties"):
-            # TODO: This can be a reference, too.
-            allow_additional = True
-        zid_dict["additionalProperties"] = allow_additional
+        zid_dict["additionalProperties"] = spec.additional_properties
 
         # Step 7: most things are objects.
         zid_dict["type"] = "object"
 
-    def generate(self, ZID, root_directory=None, tag=None, dry_run=True):
+    def generate(
+        self,
+        ZID,
+        root_directory=None,
+        tag=None,
+        dry_run=True,
+        safe=False,
+        output_format="yaml",
+        compact=False,
+    ):
+        if output_format not in ("yaml", "json"):
+            raise ValueError(f"Unknown output format: {output_format}")
+        if compact and output_format != "json":
+            raise ValueError("compact is only supported for JSON output")
+        if safe and output_format != "yaml":
+            raise ValueError("safe is only supported for YAML output")
         if root_directory is None:
             assert dry_run is True
         self._root = root_directory
         self._tag = tag
+        self._emitted = set()
 
         schema = {}
 
@@ -517,13 +808,11 @@ class SchemaComponent:
         schema["$id"] = self._id_for(ZID)
         schema.update(self._ref_dict(self._reference_for(ZID)))
 
-        # Create definitions dict.
-        object_dict = schema
-        for key in self._DEFINITIONS_PATH:
-            object_dict = object_dict.setdefault(key, {})
+        # Create definitions dict (must mirror _DEFINITIONS_PATH).
+        object_dict = {}
+        schema["definitions"] = {"objects": object_dict}
 
-        literal_spec = self._builtin_dict.get(ZID)
-        literal_spec = self._replace_references(literal_spec)
+        literal_spec = self._resolved_spec(ZID)
         literal_name = f"{ZID}_literal"
         self._to_update.append((literal_name, ZID, literal_spec))
 
@@ -531,10 +820,9 @@ class SchemaComponent:
         # or a reference (Z9).
         # This causes crazy circular reference shit.
         can_be = [self._reference_for(literal_name)]
-        cant_be = literal_spec.get("cant_be", set())
         # for ref_type in ['Z9', 'Z7']:
         for ref_type in ["Z9"]:
-            if ref_type in cant_be:
+            if ref_type in literal_spec.cant_be:
                 continue
             can_be.append(self._external_reference(ref_type))
         can_be = [self._ref_dict(elem) for elem in can_be]
@@ -548,28 +836,27 @@ class SchemaComponent:
             zid, display_zid, spec = self._to_update.pop()
             self._update_from_spec(object_dict, zid, display_zid, spec)
 
-        # Compose the resulting .yaml file.
-        #
-        # Start with comment if appropriate.
-        contents = ""
-        comment = literal_spec.get("comment")
-        if comment is not None:
-            contents += f"# {comment}\n"
-
-        # Append YAML dict.
-        fake_file = io.StringIO()
-        yaml.dump(schema, fake_file)
-        fake_file.seek(0)
-        contents += fake_file.read()
-
-        with contextlib.ExitStack() as stack:
-            if dry_run:
-                outp = sys.stdout
+        # Write the resulting file, starting with comment if appropriate.
+        if dry_run:
+            output = contextlib.nullcontext(sys.stdout)
+        else:
+            output = open(os.path.join(self._root, f"{ZID}.{output_format}"), "w")
+        with output as outp:
+            if output_format == "json":
+                # JSON has no comments, so the comment is dropped. Only compact
+                # output can use the json module's C encoder.
+                if compact:
+                    outp.write(json.dumps(schema, separators=(",", ":")))
+                else:
+                    outp.write(json.dumps(schema, indent=2))
+                outp.write("\n")
+                return
+            if literal_spec.comment is not None:
+                outp.write(f"# {literal_spec.comment}\n")
+            if safe:
+                _dump_with_pyyaml(schema, outp)
             else:
-                outp = stack.enter_context(
-                    open(os.path.join(self._root, f"{ZID}.yaml"), "w")
-                )
-            outp.write(contents)
+                _emit_yaml(schema, outp)
 
     def _list(self):
         for key in self._builtin_dict.keys():
@@ -579,14 +866,113 @@ class SchemaComponent:
         for key in self._list():
             print(key)
 
-    def generate_all(self, root_directory=None, tag=None, dry_run=True):
+    def generate_all(
+        self,
+        root_directory=None,
+        tag=None,
+        dry_run=True,
+        safe=False,
+        output_format="yaml",
+        compact=False,
+    ):
         for ZID in self._list():
-            logging.info(f"Generating config for {ZID} ...")
-            self.generate(ZID, root_directory, tag, dry_run)
+            logging.info("Generating config for %s ...", ZID)
+            self.generate(
+                ZID, root_directory, tag, dry_run, safe, output_format, compact
+            )
+
+
+def _bool_arg(value):
+    if value.lower() in ("true", "1", "yes"):
+        return True
+    if value.lower() in ("false", "0", "no"):
+        return False
+    raise argparse.ArgumentTypeError(f"expected a boolean, got {value!r}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="OpenAPI schema generation for Wikifunctions ZObjects."
+    )
+    parser.add_argument(
+        "--form", default="NORMAL", choices=[form.name for form in _COMPILED_TYPES]
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list ZIDs that have a schema")
+    generate_parser = subparsers.add_parser("generate", help="generate one schema")
+    generate_parser.add_argument("ZID")
+    generate_all_parser = subparsers.add_parser(
+        "generate_all", help="generate every schema"
+    )
+    for subparser in (generate_parser, generate_all_parser):
+        subparser.add_argument("--root_directory", "--root-directory")
+        subparser.add_argument("--tag")
+        subparser.add_argument(
+            "--dry_run",
+            "--dry-run",
+            type=_bool_arg,
+            nargs="?",
+            const=True,
+            default=True,
+        )
+        subparser.add_argument(
+            "--safe",
+            type=_bool_arg,
+            nargs="?",
+            const=True,
+            default=False,
+            help="emit YAML with yaml.dump instead of the specialized emitter",
+        )
+        subparser.add_argument(
+            "--format",
+            dest="output_format",
+            default="yaml",
+            choices=["yaml", "json"],
+            help="output format; the schemata are JSON Schema, so JSON is valid",
+        )
+        subparser.add_argument(
+            "--compact",
+            type=_bool_arg,
+            nargs="?",
+            const=True,
+            default=False,
+            help="write JSON without whitespace (fastest output)",
+        )
+    args = parser.parse_args(argv)
+
+    level = os.environ.get("LOGLEVEL", "WARNING").upper()
+    # getLevelName maps known level names to their number.
+    if not isinstance(logging.getLevelName(level), int):
+        parser.error(f"invalid LOGLEVEL: {level}")
+    logging.basicConfig(level=level)
+    component = SchemaComponent(form=args.form)
+    if args.command == "list":
+        component.list()
+        return
+    try:
+        if args.command == "generate":
+            component.generate(
+                args.ZID,
+                args.root_directory,
+                args.tag,
+                args.dry_run,
+                args.safe,
+                args.output_format,
+                args.compact,
+            )
+        else:
+            component.generate_all(
+                args.root_directory,
+                args.tag,
+                args.dry_run,
+                args.safe,
+                args.output_format,
+                args.compact,
+            )
+    except ValueError as error:
+        # Raised for option combinations generate does not support.
+        parser.error(str(error))
 
 
 if __name__ == "__main__":
-    import fire
-
-    logging.basicConfig(level=logging.DEBUG)
-    fire.Fire(SchemaComponent)
+    main()
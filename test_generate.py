@@ -0,0 +1,319 @@
+import contextlib
+import copy
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+import generate
+
+# Z4 as generated with tag "v1"; matches the output of the original script.
+Z4_SCHEMA = {
+    "$id": "v1_Z4",
+    "$ref": "#/definitions/objects/Z4",
+    "definitions": {
+        "objects": {
+            "Z4": {
+                "anyOf": [
+                    {"$ref": "#/definitions/objects/Z4_literal"},
+                    {"$ref": "v1_Z9#/definitions/objects/Z9"},
+                ]
+            },
+            "Z4_literal": {
+                "properties": {
+                    "Z1K1": {
+                        "allOf": [
+                            {"$ref": "v1_Z9#/definitions/objects/Z9"},
+                            {
+                                "type": "object",
+                                "required": ["Z1K1", "Z9K1"],
+                                "properties": {
+                                    "Z1K1": {"type": "string", "enum": ["Z9"]},
+                                    "Z9K1": {"type": "string", "enum": ["Z4"]},
+                                },
+                                "additionalProperties": False,
+                            },
+                        ]
+                    },
+                    "Z4K1": {"$ref": "#/definitions/objects/Z4"},
+                    "Z4K2": {"$ref": "#/definitions/objects/Z10_of_Z3"},
+                    "Z4K3": {"$ref": "v1_Z8#/definitions/objects/Z8"},
+                },
+                "required": ["Z1K1", "Z4K1", "Z4K2", "Z4K3"],
+                "additionalProperties": False,
+                "type": "object",
+            },
+            "Z10_of_Z3": {
+                "allOf": [
+                    {"$ref": "v1_Z10#/definitions/objects/Z10"},
+                    {
+                        "oneOf": [
+                            {"$ref": "v1_Z10#/definitions/objects/Z10_empty"},
+                            {
+                                "type": "object",
+                                "properties": {
+                                    "Z10K1": {"$ref": "v1_Z3#/definitions/objects/Z3"},
+                                    "Z10K2": {
+                                        "$ref": "#/definitions/objects/Z10_of_Z3"
+                                    },
+                                },
+                                "required": ["Z10K1", "Z10K2"],
+                            },
+                        ]
+                    },
+                ]
+            },
+        }
+    },
+}
+
+
+def generate_schema(component, ZID, tag=None, **kwargs):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        component.generate(ZID, tag=tag, output_format="json", **kwargs)
+    return json.loads(out.getvalue())
+
+
+def retag(schema, tag):
+    """Returns Z4_SCHEMA-like schema with its "v1" tag replaced by tag."""
+    prefix = "" if tag is None else f"{tag}_"
+    return json.loads(json.dumps(schema).replace('"v1_', f'"{prefix}'))
+
+
+class EmitYamlTest(unittest.TestCase):
+    def assertRoundTrips(self, value):
+        out = io.StringIO()
+        generate._emit_yaml(value, out)
+        self.assertEqual(yaml.safe_load(out.getvalue()), value)
+
+    def test_scalars(self):
+        for scalar in [
+            "Z4",
+            "Z4\n",
+            "VE\n",
+            "\nZ4",
+            "",
+            " ",
+            "$ref",
+            "#/definitions/objects/Z4",
+            r"^Z[1-9]\d*(K[1-9]\d*)?$",
+            "true",
+            "No",
+            "null",
+            "ünïcode",
+            "😀",
+            "a\U0001f600b\u00e9",
+            "\u2028\x85\x7f\ufeff\t",
+            True,
+            False,
+            None,
+            0,
+            42,
+            {},
+            [],
+        ]:
+            with self.subTest(scalar=scalar):
+                self.assertRoundTrips({"key": scalar})
+                self.assertRoundTrips({"key": [scalar]})
+                if isinstance(scalar, str):
+                    self.assertRoundTrips({scalar: False})
+
+    def test_nesting(self):
+        self.assertRoundTrips(
+            {
+                "a": {"b": [{"c": 1, "d": [["x", "y"], []]}, [{"e": None}]]},
+                "f": [[["g"]]],
+            }
+        )
+
+    def test_builtin_schemata_match_pyyaml(self):
+        component = generate.SchemaComponent()
+        with tempfile.TemporaryDirectory() as emitted, tempfile.TemporaryDirectory() as dumped:
+            component.generate_all(emitted, "test", dry_run=False)
+            component.generate_all(dumped, "test", dry_run=False, safe=True)
+            for ZID in component._list():
+                with self.subTest(ZID=ZID):
+                    with open(os.path.join(emitted, f"{ZID}.yaml")) as inp:
+                        actual = yaml.safe_load(inp)
+                    with open(os.path.join(dumped, f"{ZID}.yaml")) as inp:
+                        expected = yaml.safe_load(inp)
+                    self.assertEqual(actual, expected)
+
+
+class GenerateTest(unittest.TestCase):
+    def test_golden_schema(self):
+        self.assertEqual(
+            generate_schema(generate.SchemaComponent(), "Z4", "v1"), Z4_SCHEMA
+        )
+
+    def test_yaml_matches_json(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            generate.SchemaComponent().generate("Z4", tag="v1")
+        self.assertTrue(out.getvalue().startswith("# Z4/Type (Z4/Type)\n"))
+        self.assertEqual(yaml.safe_load(out.getvalue()), Z4_SCHEMA)
+
+    def test_tags_on_one_component(self):
+        # Resolved specs and external references are cached per tag; each
+        # call must still only see its own tag.
+        component = generate.SchemaComponent()
+        for tag in ["a", "b", None, "a", "v1"]:
+            with self.subTest(tag=tag):
+                self.assertEqual(
+                    generate_schema(component, "Z4", tag), retag(Z4_SCHEMA, tag)
+                )
+        self.assertEqual(
+            generate_schema(generate.SchemaComponent(), "Z4", "b"),
+            retag(Z4_SCHEMA, "b"),
+        )
+
+    def test_rejects_unsupported_options(self):
+        component = generate.SchemaComponent()
+        for kwargs in [
+            {"output_format": "xml"},
+            {"compact": True},
+            {"output_format": "yaml", "compact": True},
+            {"output_format": "json", "safe": True},
+        ]:
+            with self.subTest(**kwargs):
+                with self.assertRaises(ValueError):
+                    component.generate("Z4", **kwargs)
+
+    def test_generate_all_leaves_builtin_types_unchanged(self):
+        builtin_types = copy.deepcopy(generate._BUILTIN_TYPES)
+        component = generate.SchemaComponent()
+        with tempfile.TemporaryDirectory() as root:
+            component.generate_all(root, "t", dry_run=False)
+            component.generate_all(root, None, dry_run=False, output_format="json")
+        self.assertEqual(generate._BUILTIN_TYPES, builtin_types)
+        self.assertEqual(generate_schema(component, "Z4", "v1"), Z4_SCHEMA)
+
+
+class ReplaceReferencesTest(unittest.TestCase):
+    def test_leaf_key_order_does_not_matter(self):
+        component = generate.SchemaComponent()
+        component._tag = "test"
+        spec = {
+            "first": {"external": "Z10_empty", "id": "Z10"},
+            "second": {"id": "Z10", "external": "Z10_empty"},
+            "third": [{"internal": "Z4"}],
+        }
+        resolved = component._replace_references(spec)
+        self.assertEqual(
+            resolved,
+            {
+                "first": {"$ref": "test_Z10#/definitions/objects/Z10_empty"},
+                "second": {"$ref": "test_Z10#/definitions/objects/Z10_empty"},
+                "third": [{"$ref": "#/definitions/objects/Z4"}],
+            },
+        )
+
+
+class CompileSpecTest(unittest.TestCase):
+    def test_accepts_reference_leaves_in_any_key_order(self):
+        spec = generate._compile_spec(
+            {"Z1K1": "special", "Z3K1": {"id": "Z10", "external": "Z10_empty"}}
+        )
+        self.assertEqual(list(spec.properties), ["Z1K1", "Z3K1"])
+
+    def test_rejects_unrecognized_properties(self):
+        for spec in [
+            {"Z1K2": "special"},
+            {"Z3K1": {"type": "string"}},
+            {"references": {"Z3_ref": {"Z3K1": {"internal": "Z3", "x": 1, "y": 2}}}},
+        ]:
+            with self.subTest(spec=spec):
+                with self.assertRaises(ValueError):
+                    generate._compile_spec(spec)
+
+
+class MainTest(unittest.TestCase):
+    def run_main(self, *argv):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            generate.main(list(argv))
+        return out.getvalue()
+
+    def assertUsageError(self, *argv):
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit) as raised:
+                generate.main(list(argv))
+        self.assertEqual(raised.exception.code, 2)
+
+    def test_list(self):
+        self.assertEqual(
+            self.run_main("list").split(), list(generate.SchemaComponent()._list())
+        )
+
+    def test_dry_run_prints_schema(self):
+        for argv in [
+            ["generate", "Z6"],
+            ["generate", "Z6", "--dry_run"],
+            ["generate", "Z6", "--dry_run=true"],
+            ["generate", "Z6", "--dry-run", "yes"],
+        ]:
+            with self.subTest(argv=argv):
+                output = self.run_main(*argv)
+                self.assertTrue(output.startswith("# Z6/String (Z4/Type)\n"))
+                self.assertEqual(yaml.safe_load(output)["$id"], "Z6")
+
+    def test_writes_files(self):
+        for flag in ["--dry_run=false", "--dry-run=0", "--dry_run=No"]:
+            with self.subTest(flag=flag):
+                with tempfile.TemporaryDirectory() as root:
+                    output = self.run_main(
+                        "generate", "Z6", "--root_directory", root, "--tag=t", flag
+                    )
+                    self.assertEqual(output, "")
+                    with open(os.path.join(root, "Z6.yaml")) as inp:
+                        self.assertEqual(yaml.safe_load(inp)["$id"], "t_Z6")
+
+    def test_bool_flags(self):
+        for argv, expected in [
+            ([], 'pattern: "^Z'),
+            (["--safe"], "pattern: ^Z"),
+            (["--safe=true"], "pattern: ^Z"),
+            (["--safe=false"], 'pattern: "^Z'),
+            (["--format=json"], '"$id": "Z9"'),
+            (["--format", "json", "--compact"], '{"$id":"Z9"'),
+            (["--format=json", "--compact=true"], '{"$id":"Z9"'),
+            (["--format=json", "--compact=false"], '"$id": "Z9"'),
+        ]:
+            with self.subTest(argv=argv):
+                self.assertIn(expected, self.run_main("generate", "Z9", *argv))
+
+    def test_generate_all(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.run_main("generate_all", "--root-directory", root, "--dry-run=false")
+            self.assertEqual(
+                sorted(os.listdir(root)),
+                sorted(f"{ZID}.yaml" for ZID in generate.SchemaComponent()._list()),
+            )
+
+    def test_usage_errors(self):
+        for argv in [
+            [],
+            ["--form=CANONICAL", "list"],
+            ["generate"],
+            ["generate", "Z6", "--safe=maybe"],
+            ["generate", "Z6", "--format=xml"],
+            ["generate", "Z6", "--compact"],
+            ["generate_all", "--format=json", "--safe"],
+        ]:
+            with self.subTest(argv=argv):
+                self.assertUsageError(*argv)
+
+    def test_loglevel(self):
+        with mock.patch.dict(os.environ, {"LOGLEVEL": "debug"}):
+            self.run_main("list")
+        with mock.patch.dict(os.environ, {"LOGLEVEL": "verbose"}):
+            self.assertUsageError("list")
+
+
+if __name__ == "__main__":
+    unittest.main()